@@ -1,29 +1,82 @@
 # === TSC Payroll Bot — Dual Balances, Single Channel, Admin Gating, Restore Override ===
-# Storage stays in COPPER (ints). Display uses g/s/c emoji via format_currency(...).
+# Storage stays in COPPER (ints). Display uses g/s/c emoji via currency_formatter(guild_id)(...).
 # /restore override: EUGENE_ID_OVERRIDE can always run /restore, even without admin role.
 
+import aiohttp
 import discord
-from discord import File
+from discord import File, app_commands, Interaction
 from discord.ext import commands
-from discord import app_commands, Interaction
 import asyncio
-import json
+import atexit
+import contextlib
+import hashlib
+import logging
 import os
 import io
+import re
+import shutil
+import signal
+import tempfile
+import time
 import zipfile
+from collections import defaultdict
+from collections.abc import Callable
+from dataclasses import dataclass
 from datetime import datetime
 
+try:
+    import orjson  # Much faster; the stdlib json below is only a fallback
+except ImportError:
+    orjson = None
+    import json
+
 # ---------- CONFIG & CONSTANTS ----------
 CONFIG_FILE   = "config.json"
 BALANCES_FILE = "balances.json"
 REQUESTS_FILE = "requests.json"
-HISTORY_FILE  = "transactions.json"
+HISTORY_FILE  = "transactions.jsonl"
+JSON_FILES    = [CONFIG_FILE, BALANCES_FILE, REQUESTS_FILE]
+DATA_FILES    = JSON_FILES + [HISTORY_FILE]
+# Pre-JSONL history (dict of per-user lists); migrated on first load
+LEGACY_HISTORY_FILE = "transactions.json"
+# The only files /restore will write; anything else in a backup ZIP is ignored
+RESTORE_FILES = frozenset(DATA_FILES + [LEGACY_HISTORY_FILE])
+# Display names looked up via the API (cache only; not part of backups)
+NAME_CACHE_FILE = "name_cache.json"
+# Seconds a cached name is trusted before it is looked up again
+NAME_CACHE_TTL = 5 * 60
+# Hash of the last synced slash command tree
+COMMAND_HASH_FILE = ".command_hash"
+
+# Per-user transaction history cap (oldest entries are dropped past this)
+HISTORY_LIMIT = 200
+
+# /restore downloads are spooled in memory up to this size, then to disk
+RESTORE_SPOOL_MAX  = 8 * 1024 * 1024
+RESTORE_CHUNK_SIZE = 64 * 1024
+
+# Modified data files are written this many seconds after the first change,
+# so a burst of updates coalesces into one write (at most ~10 per second)
+FLUSH_DEBOUNCE = 0.1
+# Seconds between retries of writes that failed
+FLUSH_INTERVAL = 5
+
+# Max concurrent runs of the heavy commands (/balances, /backup, /restore)
+HEAVY_COMMAND_LIMIT = 4
+
+# Max pending requests /rescan_requests reposts at once
+RESCAN_CONCURRENCY = 5
+
+# Pending request embeds
+REQUEST_TITLE  = "Currency Request"
+REQUEST_COLOR  = discord.Color.gold()
+TRANSFER_TITLE = "Currency Transfer Request"
+TRANSFER_COLOR = discord.Color.orange()
 
 # Hardcoded restore override (update to YOUR Discord user ID if needed)
 EUGENE_ID_OVERRIDE = 157650335635079168
 
 # ---------- LOGGING ----------
-import logging
 logging.basicConfig(level=logging.INFO)
 
 # ---------- INTENTS / BOT ----------
@@ -31,38 +84,312 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Interactions are deferred before waiting here, so queued commands don't time out
+HEAVY_COMMAND_SLOTS = asyncio.Semaphore(HEAVY_COMMAND_LIMIT)
+
 # ---------- UTIL: JSON LOAD/SAVE ----------
-def load_json(path):
-    if not os.path.exists(path):
-        return {}
+# Data files are read once into _CACHE and served from memory afterwards.
+# Handlers mutate the cached objects in place and call mark_dirty(path);
+# flush_loop() wakes on the first change, waits FLUSH_DEBOUNCE, then writes the
+# dirty files back on a worker thread; flush_dirty() runs once more at exit so
+# nothing is lost on shutdown.
+_CACHE = {}
+_DIRTY = set()
+_FLUSH_WANTED = asyncio.Event()
+_LAST_WRITTEN = {}  # path -> hash of the bytes last written, to skip no-op flushes
+_flush_task = None
+
+def json_loads(data):
+    """Parse JSON from bytes/str; raises ValueError on bad input."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(data, indent=False, sort_keys=False) -> bytes:
+    """UTF-8 JSON bytes: compact, or 2-space indented like the data files."""
+    if orjson:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(data, option=option)
+    return json.dumps(
+        data, ensure_ascii=False, sort_keys=sort_keys,
+        indent=2 if indent else None, separators=None if indent else (",", ":"),
+    ).encode("utf-8")
+
+def read_json_file(path):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        # Corrupt / partially-written file safety
+        with open(path, "rb") as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
         return {}
+    except ValueError as e:
+        # Writes are atomic, so this is real damage, not a torn write. Keep the
+        # file for inspection; the next flush would otherwise overwrite it with {}.
+        aside = f"{path}.corrupt-{datetime.now():%Y%m%d-%H%M%S}"
+        print(f"⚠️ {path} is not valid JSON ({e}); moved to {aside}, starting empty")
+        with contextlib.suppress(OSError):
+            os.replace(path, aside)
+        return {}
+
+def dump_json(data) -> bytes:
+    return json_dumps(data, indent=True)
+
+def write_file_atomic(path, payload: bytes):
+    # Write to a fresh temp file, fsync it and swap it in, so a crash or a full
+    # disk never leaves a torn or empty file behind
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                               dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+def load_json(path):
+    """Return the in-memory copy of a data file, reading it on first use."""
+    data = _CACHE.get(path)
+    if data is None:
+        data = _CACHE[path] = read_json_file(path)
+    return data
+
+async def load_json_async(path):
+    """Like load_json, but a cache miss is read on a worker thread."""
+    if path not in _CACHE:
+        data = await asyncio.to_thread(read_json_file, path)
+        _CACHE.setdefault(path, data)
+    return _CACHE[path]
+
+def mark_dirty(path):
+    """Schedule the cached copy of path to be written back by the flusher."""
+    _DIRTY.add(path)
+    _FLUSH_WANTED.set()
+
+# One lock per data file, held across read-modify-write sections that may yield
+_LOCKS = defaultdict(asyncio.Lock)
+
+@contextlib.asynccontextmanager
+async def locked(*paths):
+    """Hold the locks for several data files, always acquired in the same order."""
+    async with contextlib.AsyncExitStack() as stack:
+        for path in sorted(set(paths)):
+            await stack.enter_async_context(_LOCKS[path])
+        yield
+
+def flush_dirty():
+    for path in list(_DIRTY):
+        _DIRTY.discard(path)
+        data = _CACHE.get(path)
+        if data is None:
+            # e.g. /restore reset the cache after a handler marked it dirty
+            print(f"⚠️ {path} was marked dirty but isn't loaded; skipping")
+            continue
+        try:
+            payload = dump_json(data)
+            digest = hash(payload)
+            if _LAST_WRITTEN.get(path) == digest:
+                continue
+            write_file_atomic(path, payload)
+            _LAST_WRITTEN[path] = digest
+        except Exception as e:
+            _DIRTY.add(path)
+            print(f"⚠️ Failed to write {path}: {e}")
+
+async def flush_dirty_async():
+    """Serialize dirty files on the loop (a consistent snapshot), write them off it."""
+    for path in list(_DIRTY):
+        async with _LOCKS[path]:
+            if path not in _DIRTY:
+                continue  # Dropped by /restore while we waited
+            _DIRTY.discard(path)
+            data = _CACHE.get(path)
+            if data is None:
+                # e.g. /restore reset the cache after a handler marked it dirty
+                print(f"⚠️ {path} was marked dirty but isn't loaded; skipping")
+                continue
+            try:
+                payload = dump_json(data)
+                digest = hash(payload)
+                if _LAST_WRITTEN.get(path) == digest:
+                    continue  # Marked dirty, but the content is what's already on disk
+                await asyncio.to_thread(write_file_atomic, path, payload)
+                _LAST_WRITTEN[path] = digest
+            except Exception as e:
+                _DIRTY.add(path)
+                print(f"⚠️ Failed to write {path}: {e}")
+
+def reset_cache():
+    """Forget all cached data (e.g. after /restore replaced the files on disk)."""
+    global _MSG_TO_REQ, _HISTORY
+    _CACHE.clear()
+    _DIRTY.clear()
+    _LAST_WRITTEN.clear()
+    _HISTORY = None
+    _HISTORY_PENDING.clear()
+    _GUILD_CTX.clear()
+    _MSG_TO_REQ = None
+
+async def flush_loop():
+    while True:
+        try:
+            # Failed writes stay pending without a new change, so also retry periodically
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_FLUSH_WANTED.wait(), FLUSH_INTERVAL)
+            await asyncio.sleep(FLUSH_DEBOUNCE)
+            _FLUSH_WANTED.clear()
+            await flush_dirty_async()
+            await flush_history_async()
+        except Exception as e:
+            # Never let one bad pass end the task: later changes would stay in memory only
+            print(f"⚠️ Flush pass failed: {e!r}")
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+atexit.register(flush_dirty)
+
+# ---------- UTIL: TRANSACTION LOG ----------
+# History is an append-only JSON Lines file, one {"uid": ..., **entry} per line.
+# It is read once into _HISTORY (uid -> newest HISTORY_LIMIT entries); new
+# entries are queued in _HISTORY_PENDING and appended by the flusher, so a
+# transaction costs a one-line append rather than a rewrite of all history.
+# The file is compacted back down to the capped entries whenever it's loaded.
+_HISTORY = None
+_HISTORY_PENDING = []
+
+def history_line(uid, entry) -> bytes:
+    if isinstance(entry, str):  # Very old free-text entries
+        return json_dumps({"uid": uid, "legacy": entry}) + b"\n"
+    return json_dumps({"uid": uid, **entry}) + b"\n"
+
+def dump_history(history) -> bytes:
+    return b"".join(history_line(uid, e) for uid, lst in history.items() for e in lst)
+
+def read_history_file():
+    """Blocking: build the per-user history, compacting or migrating the file."""
+    history = {}
+    if os.path.exists(HISTORY_FILE):
+        compact = False
+        with open(HISTORY_FILE, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rec = json_loads(line)
+                except ValueError:
+                    compact = True  # Torn last line from a crash mid-append
+                    continue
+                uid = rec.pop("uid", None)
+                if uid is not None:
+                    history.setdefault(uid, []).append(rec.get("legacy", rec))
+    else:
+        history = read_json_file(LEGACY_HISTORY_FILE)
+        compact = bool(history)
+    if trim_history(history) or compact:
+        write_file_atomic(HISTORY_FILE, dump_history(history))
+    return history
+
+def load_history():
+    """Return the in-memory per-user history, reading it on first use."""
+    global _HISTORY
+    if _HISTORY is None:
+        _HISTORY = read_history_file()
+    return _HISTORY
+
+async def load_history_async():
+    global _HISTORY
+    if _HISTORY is None:
+        # Hold the log's lock: the read may compact (rewrite) the file, and an append
+        # from the flusher in the meantime would be replaced by the stale snapshot
+        async with _LOCKS[HISTORY_FILE]:
+            if _HISTORY is None:
+                _HISTORY = await asyncio.to_thread(read_history_file)
+    return _HISTORY
+
+def append_file(path, payload: bytes):
+    with open(path, "ab") as f:
+        f.write(payload)
+
+def flush_history():
+    if _HISTORY_PENDING:
+        payload = b"".join(_HISTORY_PENDING)
+        _HISTORY_PENDING.clear()
+        append_file(HISTORY_FILE, payload)
+
+async def flush_history_async():
+    if not _HISTORY_PENDING:
+        return
+    async with _LOCKS[HISTORY_FILE]:
+        payload = b"".join(_HISTORY_PENDING)
+        _HISTORY_PENDING.clear()
+        if not payload:
+            return  # Dropped by /restore while we waited
+        try:
+            await asyncio.to_thread(append_file, HISTORY_FILE, payload)
+        except Exception as e:
+            _HISTORY_PENDING.insert(0, payload)
+            print(f"⚠️ Failed to write {HISTORY_FILE}: {e}")
 
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+atexit.register(flush_history)
 
 # ---------- UTIL: ADMIN / CHANNEL / CURRENCY ----------
-def is_admin(interaction: Interaction) -> bool:
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id), {})
-    admin_roles = set(cfg.get("admin_roles", []))
-    if not hasattr(interaction.user, "roles"):
+def get_guild_cfg(guild_id) -> dict:
+    """The guild's /setup config from the cached config file ({} if not set up)."""
+    return load_json(CONFIG_FILE).get(str(guild_id), {})
+
+@dataclass(frozen=True, slots=True)
+class GuildEmojis:
+    gold: str = "g"
+    silver: str = "s"
+    copper: str = "c"
+
+DEFAULT_EMOJIS = GuildEmojis()
+
+@dataclass(frozen=True, slots=True)
+class GuildCtx:
+    """What the handlers need from a guild's config, prebuilt once."""
+    request_channel: int | None
+    admin_roles: frozenset
+    emojis: GuildEmojis
+    fmt: Callable[[int], str]  # currency formatter with emojis baked in
+
+# guild id (str) -> GuildCtx; dropped by /setup, cleared by /restore
+_GUILD_CTX = {}
+
+def guild_ctx(guild_id) -> GuildCtx:
+    gid = str(guild_id)
+    ctx = _GUILD_CTX.get(gid)
+    if ctx is None:
+        cfg = get_guild_cfg(gid)
+        e = cfg.get("emojis")
+        # Pick known keys only: hand-edited configs and old backups may carry extras
+        emojis = GuildEmojis(
+            gold=e.get("gold", "g"), silver=e.get("silver", "s"), copper=e.get("copper", "c")
+        ) if e else DEFAULT_EMOJIS
+        ctx = _GUILD_CTX[gid] = GuildCtx(
+            request_channel=cfg.get("request_channel"),
+            admin_roles=frozenset(cfg.get("admin_roles", [])),
+            emojis=emojis,
+            fmt=make_currency_formatter(emojis),
+        )
+    return ctx
+
+def member_is_admin(member, guild_id) -> bool:
+    roles = getattr(member, "roles", None)
+    if not roles:
         return False
-    return any(role.id in admin_roles for role in interaction.user.roles)
+    return not guild_ctx(guild_id).admin_roles.isdisjoint(role.id for role in roles)
+
+def is_admin(interaction: Interaction) -> bool:
+    return member_is_admin(interaction.user, interaction.guild.id)
 
 async def enforce_request_channel(interaction: Interaction) -> bool:
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id))
-    if not cfg:
+    req_chan_id = guild_ctx(interaction.guild.id).request_channel
+    if req_chan_id is None:
         await interaction.response.send_message("❌ No config found. Please run `/setup`.", ephemeral=True)
         return False
-    req_chan_id = cfg.get("request_channel")
-    if not req_chan_id or interaction.channel.id != req_chan_id:
+    if interaction.channel.id != req_chan_id:
         # Soft error (ephemeral) to guide user to the correct place
-        chan = interaction.guild.get_channel(req_chan_id) if req_chan_id else None
+        chan = interaction.guild.get_channel(req_chan_id)
         where = chan.mention if chan else "#configured-channel"
         try:
             await interaction.response.send_message(
@@ -77,16 +404,21 @@ async def enforce_request_channel(interaction: Interaction) -> bool:
         return False
     return True
 
-def format_currency(value: int, guild_id: int) -> str:
-    cfg = load_json(CONFIG_FILE).get(str(guild_id), {})
-    emojis = cfg.get("emojis", {})
-    g = emojis.get("gold", "g")
-    s = emojis.get("silver", "s")
-    c = emojis.get("copper", "c")
-    gold  = value // 10000
-    silver = (value % 10000) // 100
-    copper = value % 100
-    return f"{gold}{g} {silver:02}{s} {copper:02}{c}"
+# "00".."99", so silver/copper padding is a list index rather than a format spec
+_TWO_DIGIT = [f"{i:02}" for i in range(100)]
+
+def make_currency_formatter(e: GuildEmojis):
+    """Build a copper -> "Xg YYs ZZc" formatter with e's emoji bound as locals."""
+    g, s, c = e.gold, e.silver, e.copper
+    def fmt(value: int) -> str:
+        gold, rem = divmod(value, 10000)
+        silver, copper = divmod(rem, 100)
+        return f"{gold}{g} {_TWO_DIGIT[silver]}{s} {_TWO_DIGIT[copper]}{c}"
+    return fmt
+
+def currency_formatter(guild_id):
+    """The guild's cached copper -> g/s/c formatter."""
+    return guild_ctx(guild_id).fmt
 
 def ensure_user_bucket(bal):
     """Tolerate legacy (int) -> always return dict with 'banked' and 'debt'."""
@@ -95,21 +427,226 @@ def ensure_user_bucket(bal):
     # Fill missing keys if needed
     return {"banked": int(bal.get("banked", 0)), "debt": int(bal.get("debt", 0))}
 
+def trim_history(history) -> bool:
+    """Cap every user's list (files written before HISTORY_LIMIT may be longer)."""
+    trimmed = False
+    for lst in history.values():
+        if isinstance(lst, list) and len(lst) > HISTORY_LIMIT:
+            del lst[:-HISTORY_LIMIT]
+            trimmed = True
+    return trimmed
+
+def push_history(history, uid, entry):
+    """Log a transaction for uid; memory keeps only the newest HISTORY_LIMIT."""
+    _HISTORY_PENDING.append(history_line(uid, entry))
+    _FLUSH_WANTED.set()
+    lst = history.setdefault(uid, [])
+    lst.append(entry)
+    if len(lst) > HISTORY_LIMIT:
+        del lst[:-HISTORY_LIMIT]
+
+# Gateway member queries accept at most 100 user ids each
+MEMBER_QUERY_LIMIT = 100
+
+async def query_member_names(guild, user_ids):
+    """Resolve guild members over the gateway, 100 ids per request, all chunks at once."""
+    async def query(chunk):
+        try:
+            return await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True)
+        except Exception:
+            return []
+
+    chunks = [
+        [int(uid) for uid in user_ids[i:i + MEMBER_QUERY_LIMIT]]
+        for i in range(0, len(user_ids), MEMBER_QUERY_LIMIT)
+    ]
+    results = await asyncio.gather(*(query(chunk) for chunk in chunks))
+    return {str(m.id): m.name for members in results for m in members}
+
+def cached_name(entry):
+    """(name, time cached) from a name cache entry; bare names are from before the TTL."""
+    if isinstance(entry, dict):
+        return entry.get("name"), entry.get("at", 0)
+    return entry, 0
+
+async def resolve_user_names(user_ids, guild=None):
+    """Map user ids (str) to names: client/member cache, fresh name cache entries,
+    then the API; a stale cached name is only used if the lookup fails."""
+    name_cache = load_json(NAME_CACHE_FILE)
+    now = time.time()
+    names = {}
+    looked_up = set()  # resolved via the API, so their cache entries get a new time
+    missing = []
+    for uid in user_ids:
+        user = bot.get_user(int(uid)) or (guild and guild.get_member(int(uid)))
+        if user:
+            names[uid] = user.name
+            continue
+        name, at = cached_name(name_cache.get(uid))
+        if name and now - at < NAME_CACHE_TTL:
+            names[uid] = name
+        else:
+            missing.append(uid)
+
+    async def fetch_name(uid):
+        try:
+            return (await bot.fetch_user(int(uid))).name
+        except Exception:
+            return None
+
+    # One gateway request per 100 guild members, then REST only for whoever's left
+    if guild and missing:
+        queried = await query_member_names(guild, missing)
+        names.update(queried)
+        looked_up.update(queried)
+        missing = [uid for uid in missing if uid not in names]
+
+    fetched = await asyncio.gather(*(fetch_name(uid) for uid in missing))
+    for uid, name in zip(missing, fetched):
+        if name:
+            names[uid] = name
+            looked_up.add(uid)
+
+    # Remember the names we resolved so the next listing needs no API calls.
+    # Re-read the cache: a /restore during the awaits above may have replaced it.
+    name_cache = load_json(NAME_CACHE_FILE)
+    changed = False
+    for uid in user_ids:
+        old_name, _at = cached_name(name_cache.get(uid))
+        if uid not in names:
+            if old_name:
+                names[uid] = old_name  # Lookup failed; a stale name beats none
+            continue
+        if uid in looked_up or names[uid] != old_name:
+            name_cache[uid] = {"name": names[uid], "at": now}
+            changed = True
+    if changed:
+        mark_dirty(NAME_CACHE_FILE)
+    return names
+
+# Discord rejects messages over 2000 characters; leave some headroom
+MESSAGE_CHUNK_LIMIT = 1900
+
+async def send_lines(interaction: Interaction, lines, **kwargs):
+    """Send lines as followups, splitting into as many messages as needed."""
+    chunk, size = [], 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > MESSAGE_CHUNK_LIMIT:
+            await interaction.followup.send("\n".join(chunk), **kwargs)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        await interaction.followup.send("\n".join(chunk), **kwargs)
+
+# ---------- UTIL: PENDING REQUEST MESSAGES ----------
+# message id -> request id for each pending request whose embed was posted,
+# built lazily from the "message_id" stored on each request. Requests posted
+# before message ids were stored are kept in _UNINDEXED_REQS; while any exist,
+# reactions on unknown messages still fall back to reading the embed footer.
+_MSG_TO_REQ = None
+_UNINDEXED_REQS = set()
+
+def request_message_index():
+    global _MSG_TO_REQ
+    if _MSG_TO_REQ is None:
+        _MSG_TO_REQ = {}
+        _UNINDEXED_REQS.clear()
+        for key, data in load_json(REQUESTS_FILE).items():
+            msg_id = data.get("message_id")
+            if msg_id:
+                _MSG_TO_REQ[msg_id] = key
+            else:
+                _UNINDEXED_REQS.add(key)
+    return _MSG_TO_REQ
+
+def index_request_message(req_id, message_id):
+    """Record the message that carries a pending request (hold the requests lock)."""
+    data = load_json(REQUESTS_FILE).get(req_id)
+    if data is None:
+        return  # Resolved while we were posting
+    index = request_message_index()
+    index.pop(data.get("message_id"), None)
+    data["message_id"] = message_id
+    index[message_id] = req_id
+    _UNINDEXED_REQS.discard(req_id)
+    mark_dirty(REQUESTS_FILE)
+
+def unindex_request(req_id, data):
+    if _MSG_TO_REQ is not None:
+        _MSG_TO_REQ.pop(data.get("message_id"), None)
+    _UNINDEXED_REQS.discard(req_id)
+
+async def drop_request(req_id):
+    """Forget a pending request whose embed never got posted (nobody could approve it)."""
+    async with locked(REQUESTS_FILE):
+        data = load_json(REQUESTS_FILE).pop(req_id, None)
+        if data is not None:
+            unindex_request(req_id, data)
+            mark_dirty(REQUESTS_FILE)
+
 # ---------- STARTUP ----------
+def command_tree_hash() -> str:
+    """Fingerprint of the slash command definitions, used to skip redundant syncs."""
+    payload = []
+    for cmd in bot.tree.get_commands():
+        try:
+            payload.append(cmd.to_dict(bot.tree))
+        except TypeError:  # discord.py < 2.4
+            payload.append(cmd.to_dict())
+    return hashlib.sha256(json_dumps(payload, sort_keys=True)).hexdigest()
+
+def read_command_hash():
+    try:
+        with open(COMMAND_HASH_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_command_hash(tree_hash):
+    with open(COMMAND_HASH_FILE, "w", encoding="utf-8") as f:
+        f.write(tree_hash)
+
+_close_task = None
+
+def close_on_sigterm():
+    """Hosts stop the bot with SIGTERM. Close it as Ctrl+C would, so bot.run() returns
+    and the atexit flushes write out pending changes."""
+    global _close_task
+    if _close_task is None:  # Keep a reference so the task can't be garbage-collected
+        _close_task = asyncio.create_task(bot.close())
+
 @bot.event
 async def on_ready():
     print(f"✅ Logged in as {bot.user} (id={bot.user.id})")
     try:
-        synced = await bot.tree.sync()
-        print(f"✅ Synced {len(synced)} commands")
+        # Global syncs are heavily rate-limited; only sync when the commands changed
+        tree_hash = command_tree_hash()
+        if read_command_hash() != tree_hash:
+            synced = await bot.tree.sync()
+            write_command_hash(tree_hash)
+            print(f"✅ Synced {len(synced)} commands")
+        else:
+            print("✅ Commands unchanged since last sync")
     except Exception as e:
         print(f"⚠️ Sync failed: {e}")
 
-    config_exists = os.path.exists(CONFIG_FILE)
-    config = load_json(CONFIG_FILE) if config_exists else {}
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(flush_loop())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, close_on_sigterm)
+        except NotImplementedError:  # No signal handlers on Windows
+            pass
+
+    # Warm the cache off the event loop so handlers never block on a first read
+    for path in JSON_FILES + [NAME_CACHE_FILE]:
+        await load_json_async(path)
+    await load_history_async()
+
     for guild in bot.guilds:
         try:
-            cfg = config.get(str(guild.id), {})
+            cfg = get_guild_cfg(guild.id)
             channel_id = cfg.get("request_channel")
             channel = None
             if channel_id:
@@ -118,7 +655,7 @@ async def on_ready():
                 channel = guild.system_channel or discord.utils.get(guild.text_channels, name="general")
 
             if channel:
-                if config_exists and str(guild.id) in config:
+                if cfg:
                     await channel.send("🔔 Currency bot is online and ready!")
                 else:
                     await channel.send(
@@ -161,7 +698,8 @@ async def setup(interaction: Interaction, channel: discord.TextChannel, role: di
         "admin_roles": [role.id],
         "emojis": {"gold": gold, "silver": silver, "copper": copper},
     }
-    save_json(CONFIG_FILE, cfg)
+    mark_dirty(CONFIG_FILE)
+    _GUILD_CTX.pop(str(interaction.guild.id), None)  # Rebuilt from the new config on next use
     await interaction.response.send_message(
         f"✅ Setup complete!\n"
         f"Commands & requests will use {channel.mention}.\n"
@@ -170,6 +708,15 @@ async def setup(interaction: Interaction, channel: discord.TextChannel, role: di
     )
 
 # ---------- BACKUP / RESTORE ----------
+def build_backup_zip(snapshot):
+    """Blocking: compress {filename: bytes} into an in-memory ZIP."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for name, payload in snapshot.items():
+            zipf.writestr(name, payload)
+    buf.seek(0)
+    return buf
+
 @bot.tree.command(name="backup", description="Admin: Download all config and data.")
 async def backup_command(interaction: Interaction):
     if not await enforce_request_channel(interaction):
@@ -179,17 +726,55 @@ async def backup_command(interaction: Interaction):
         return
 
     await interaction.response.defer(ephemeral=True, thinking=True)
+    async with HEAVY_COMMAND_SLOTS:
+        try:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            zip_filename = f"currency_backup_{timestamp}.zip"
+            # Snapshot straight from memory: consistent, and includes unflushed changes
+            snapshot = {
+                file: dump_json(load_json(file))
+                for file in JSON_FILES
+                if load_json(file) or os.path.exists(file)
+            }
+            snapshot[HISTORY_FILE] = dump_history(load_history())
+            buf = await asyncio.to_thread(build_backup_zip, snapshot)
+            await interaction.followup.send("📦 Backup file:", file=File(buf, filename=zip_filename), ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ Failed to create backup: {e}", ephemeral=True)
+
+async def download_to_spool(url):
+    """Stream an attachment into a SpooledTemporaryFile without buffering it whole."""
+    spool = tempfile.SpooledTemporaryFile(max_size=RESTORE_SPOOL_MAX)
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        zip_filename = f"currency_backup_{timestamp}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file in [CONFIG_FILE, BALANCES_FILE, REQUESTS_FILE, HISTORY_FILE]:
-                if os.path.exists(file):
-                    zipf.write(file)
-        await interaction.followup.send("📦 Backup file:", file=File(zip_filename), ephemeral=True)
-        os.remove(zip_filename)
-    except Exception as e:
-        await interaction.followup.send(f"❌ Failed to create backup: {e}", ephemeral=True)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(RESTORE_CHUNK_SIZE):
+                    spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+def extract_backup(fileobj):
+    """Blocking: write the backup ZIP's data files into the working directory."""
+    written = set()
+    with zipfile.ZipFile(fileobj, "r") as zipf:
+        for name in zipf.namelist():
+            # Flatten entry paths so an archive can't write outside the bot directory
+            target = os.path.basename(name)
+            if target not in RESTORE_FILES:
+                print(f"⚠️ Skipping unexpected backup entry: {name}")
+                continue
+            with zipf.open(name) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, RESTORE_CHUNK_SIZE)
+            written.add(target)
+    # A backup from before the JSONL log only has the old history file;
+    # drop the current log so it is migrated from the restored one on load.
+    if LEGACY_HISTORY_FILE in written and HISTORY_FILE not in written:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(HISTORY_FILE)
 
 @bot.tree.command(name="restore", description="Restore data from a backup ZIP file.")
 async def restore(interaction: Interaction, file: discord.Attachment):
@@ -199,7 +784,7 @@ async def restore(interaction: Interaction, file: discord.Attachment):
         return
 
     # If a config exists, enforce the configured command channel.
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id))
+    cfg = get_guild_cfg(interaction.guild.id)
     if cfg:
         if not await enforce_request_channel(interaction):
             return
@@ -219,16 +804,23 @@ async def restore(interaction: Interaction, file: discord.Attachment):
         return
 
     # Do the restore
-    try:
-        zip_bytes = await file.read()
-        import io, zipfile
-        with zipfile.ZipFile(io.BytesIO(zip_bytes), "r") as zipf:
-            for name in zipf.namelist():
-                with zipf.open(name) as src, open(name, "wb") as dst:
-                    dst.write(src.read())
-        await interaction.followup.send("✅ Restore complete.", ephemeral=True)
-    except Exception as e:
-        await interaction.followup.send(f"❌ Restore failed: {e}", ephemeral=True)
+    async with HEAVY_COMMAND_SLOTS:
+        try:
+            spool = await download_to_spool(file.url)
+            try:
+                async with locked(*DATA_FILES):
+                    try:
+                        # Pending writes must not land on top of the restored files
+                        _DIRTY.clear()
+                        _HISTORY_PENDING.clear()
+                        await asyncio.to_thread(extract_backup, spool)
+                    finally:
+                        reset_cache()
+            finally:
+                spool.close()
+            await interaction.followup.send("✅ Restore complete.", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ Restore failed: {e}", ephemeral=True)
 
 # ---------- COMMANDS: GIVE / TAKE ----------
 def normalize_balance_type(balance: str) -> str:
@@ -248,22 +840,23 @@ async def give(interaction: Interaction, user: discord.Member, balance: str, amo
 
     await interaction.response.defer(ephemeral=False, thinking=True)
     balance = normalize_balance_type(balance)
-    balances = load_json(BALANCES_FILE)
-    uid = str(user.id)
-    bal = ensure_user_bucket(balances.get(uid, {}))
-    bal[balance] = bal.get(balance, 0) + amount
-    balances[uid] = bal
-    save_json(BALANCES_FILE, balances)
-
-    history = load_json(HISTORY_FILE)
-    history.setdefault(uid, []).append(
-        {"type": "grant", "amount": amount, "reason": reason, "by": interaction.user.id, "balance": balance}
-    )
-    save_json(HISTORY_FILE, history)
+    async with locked(BALANCES_FILE, HISTORY_FILE):
+        balances = load_json(BALANCES_FILE)
+        uid = str(user.id)
+        bal = ensure_user_bucket(balances.get(uid, {}))
+        bal[balance] = bal.get(balance, 0) + amount
+        balances[uid] = bal
+        mark_dirty(BALANCES_FILE)
+
+        history = load_history()
+        push_history(history, uid,
+            {"type": "grant", "amount": amount, "reason": reason, "by": interaction.user.id, "balance": balance}
+        )
 
+    fmt = currency_formatter(interaction.guild.id)
     await interaction.followup.send(
-        f"✅ Granted {format_currency(amount, interaction.guild.id)} ({balance}) to {user.mention}. "
-        f"New {balance}: {format_currency(bal[balance], interaction.guild.id)}"
+        f"✅ Granted {fmt(amount)} ({balance}) to {user.mention}. "
+        f"New {balance}: {fmt(bal[balance])}"
     )
 
 @bot.tree.command(name="take", description="(Admin) Remove currency from a user.")
@@ -277,22 +870,23 @@ async def take(interaction: Interaction, user: discord.Member, balance: str, amo
 
     await interaction.response.defer(ephemeral=False, thinking=True)
     balance = normalize_balance_type(balance)
-    balances = load_json(BALANCES_FILE)
-    uid = str(user.id)
-    bal = ensure_user_bucket(balances.get(uid, {}))
-    bal[balance] = max(0, bal.get(balance, 0) - amount)
-    balances[uid] = bal
-    save_json(BALANCES_FILE, balances)
-
-    history = load_json(HISTORY_FILE)
-    history.setdefault(uid, []).append(
-        {"type": "deduct", "amount": amount, "reason": reason, "by": interaction.user.id, "balance": balance}
-    )
-    save_json(HISTORY_FILE, history)
+    async with locked(BALANCES_FILE, HISTORY_FILE):
+        balances = load_json(BALANCES_FILE)
+        uid = str(user.id)
+        bal = ensure_user_bucket(balances.get(uid, {}))
+        bal[balance] = max(0, bal.get(balance, 0) - amount)
+        balances[uid] = bal
+        mark_dirty(BALANCES_FILE)
+
+        history = load_history()
+        push_history(history, uid,
+            {"type": "deduct", "amount": amount, "reason": reason, "by": interaction.user.id, "balance": balance}
+        )
 
+    fmt = currency_formatter(interaction.guild.id)
     await interaction.followup.send(
-        f"✅ Deducted {format_currency(amount, interaction.guild.id)} ({balance}) from {user.mention}. "
-        f"New {balance}: {format_currency(bal[balance], interaction.guild.id)}"
+        f"✅ Deducted {fmt(amount)} ({balance}) from {user.mention}. "
+        f"New {balance}: {fmt(bal[balance])}"
     )
 
 # ---------- COMMANDS: BALANCE / BALANCES ----------
@@ -311,8 +905,9 @@ async def balance_command(interaction: Interaction, user: discord.User = None):
     await interaction.response.defer(ephemeral=True, thinking=True)
     balances = load_json(BALANCES_FILE)
     bal = ensure_user_bucket(balances.get(str(target.id), {}))
-    banked_str = format_currency(bal["banked"], interaction.guild.id)
-    debt_str   = format_currency(bal["debt"],   interaction.guild.id)
+    fmt = currency_formatter(interaction.guild.id)
+    banked_str = fmt(bal["banked"])
+    debt_str   = fmt(bal["debt"])
     await interaction.followup.send(
         f"💰 Balances for {'you' if is_self else target.mention}: {banked_str} banked, {debt_str} debt",
         ephemeral=True
@@ -334,42 +929,63 @@ async def balances_command(interaction: Interaction):
 
     await interaction.response.defer(ephemeral=True, thinking=True)
 
-    total_banked = 0
-    total_debt = 0
-    msg_lines = ["**📊 All User Balances:**"]
+    async with HEAVY_COMMAND_SLOTS:
+        total_banked = 0
+        total_debt = 0
+        msg_lines = ["**📊 All User Balances:**"]
 
-    def combined_total(item):
-        _uid, b = item
-        if isinstance(b, int):
-            return b
-        return int(b.get("banked", 0)) + int(b.get("debt", 0))
+        def combined_total(item):
+            _uid, b = item
+            if isinstance(b, int):
+                return b
+            return int(b.get("banked", 0)) + int(b.get("debt", 0))
 
-    sorted_entries = sorted(balances.items(), key=combined_total, reverse=True)
+        sorted_entries = sorted(balances.items(), key=combined_total, reverse=True)
+        names = await resolve_user_names([user_id for user_id, _b in sorted_entries], interaction.guild)
+        fmt = currency_formatter(interaction.guild.id)
 
-    for user_id, b in sorted_entries:
-        b = ensure_user_bucket(b)
-        total_banked += b["banked"]
-        total_debt   += b["debt"]
-
-        # Resolve display name
-        try:
-            u = await interaction.client.fetch_user(int(user_id))
-            name = u.name
-        except Exception:
-            name = f"User {user_id}"
+        for user_id, b in sorted_entries:
+            b = ensure_user_bucket(b)
+            total_banked += b["banked"]
+            total_debt   += b["debt"]
+            name = names.get(user_id) or f"User {user_id}"
 
-        banked_str = format_currency(b["banked"], interaction.guild.id)
-        debt_str   = format_currency(b["debt"],   interaction.guild.id)
-        msg_lines.append(f"{name}: {banked_str} banked, {debt_str} debt")
+            banked_str = fmt(b["banked"])
+            debt_str   = fmt(b["debt"])
+            msg_lines.append(f"{name}: {banked_str} banked, {debt_str} debt")
 
-    msg_lines.append("")
-    total_banked_str = format_currency(total_banked, interaction.guild.id)
-    total_debt_str   = format_currency(total_debt,   interaction.guild.id)
-    msg_lines.append(f"**Total:** {total_banked_str} banked, {total_debt_str} debt")
+        msg_lines.append("")
+        total_banked_str = fmt(total_banked)
+        total_debt_str   = fmt(total_debt)
+        msg_lines.append(f"**Total:** {total_banked_str} banked, {total_debt_str} debt")
 
-    await interaction.followup.send("\n".join(msg_lines), allowed_mentions=discord.AllowedMentions.none(), ephemeral=True)
+        await send_lines(interaction, msg_lines, allowed_mentions=discord.AllowedMentions.none(), ephemeral=True)
 
 # ---------- COMMANDS: REQUEST / TRANSFER ----------
+def build_request_embed(req_id, data, fmt):
+    """Embed for a stored pending request (None for unknown types); footer carries ReqID."""
+    t = data.get("type")
+    amount = int(data["amount"])
+    balance = data.get("balance", "banked")
+    reason = data.get("reason", "")
+    if t == "request":
+        embed = discord.Embed(
+            title=REQUEST_TITLE,
+            description=f"<@{data['user_id']}> is requesting {fmt(amount)} ({balance})\nReason: {reason}",
+            color=REQUEST_COLOR
+        )
+        embed.set_footer(text=f"Request | User: {data['user_id']} | Amount: {amount} | Balance: {balance} | ReqID: {req_id}")
+    elif t == "transfer":
+        embed = discord.Embed(title=TRANSFER_TITLE, color=TRANSFER_COLOR)
+        embed.add_field(name="From", value=f"<@{data['from']}>", inline=True)
+        embed.add_field(name="To", value=f"<@{data['to']}>", inline=True)
+        embed.add_field(name="Amount", value=f"{fmt(amount)} ({balance})", inline=False)
+        embed.add_field(name="Reason", value=reason, inline=False)
+        embed.set_footer(text=f"Transfer | From: {data['from']} | To: {data['to']} | Amount: {amount} | Balance: {balance} | ReqID: {req_id}")
+    else:
+        return None
+    return embed
+
 @bot.tree.command(name="request", description="Request currency (queued for admin approval).")
 @app_commands.describe(balance="banked or debt", amount="Amount in copper", reason="Reason")
 async def request_command(interaction: Interaction, balance: str, amount: int, reason: str):
@@ -378,36 +994,35 @@ async def request_command(interaction: Interaction, balance: str, amount: int, r
     await interaction.response.defer(ephemeral=False, thinking=True)
 
     balance = normalize_balance_type(balance)
-    reqs = load_json(REQUESTS_FILE)
-    req_id = str(interaction.id)
-    reqs[req_id] = {
-        "type": "request",
-        "user_id": str(interaction.user.id),
-        "amount": int(amount),
-        "reason": reason,
-        "balance": balance
-    }
-    save_json(REQUESTS_FILE, reqs)
-
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id), {})
-    channel = interaction.guild.get_channel(cfg.get("request_channel"))
-    if not channel:
-        await interaction.followup.send("❌ Request channel not configured.", ephemeral=False)
-        return
-
-    embed = discord.Embed(
-        title="Currency Request",
-        description=f"{interaction.user.mention} is requesting {format_currency(amount, interaction.guild.id)} ({balance})\nReason: {reason}",
-        color=discord.Color.gold()
-    )
-    embed.set_footer(text=f"Request | User: {interaction.user.id} | Amount: {amount} | Balance: {balance}")
+    async with locked(REQUESTS_FILE):
+        reqs = load_json(REQUESTS_FILE)
+        req_id = str(interaction.id)
+        data = reqs[req_id] = {
+            "type": "request",
+            "user_id": str(interaction.user.id),
+            "amount": int(amount),
+            "reason": reason,
+            "balance": balance
+        }
+        mark_dirty(REQUESTS_FILE)
+
+    # enforce_request_channel() already guaranteed we're in the configured channel
+    channel = interaction.channel
+
+    embed = build_request_embed(req_id, data, currency_formatter(interaction.guild.id))
+    msg = None
     try:
         msg = await channel.send(embed=embed)
-        await msg.add_reaction("✅")
-        await msg.add_reaction("❌")
+        async with locked(REQUESTS_FILE):
+            index_request_message(req_id, msg.id)
+        await asyncio.gather(msg.add_reaction("✅"), msg.add_reaction("❌"))
         await interaction.followup.send("📝 Your request has been submitted for approval.", ephemeral=False)
     except discord.Forbidden:
         await interaction.followup.send("❌ I don't have permission to post in the configured channel.", ephemeral=True)
+    finally:
+        if msg is None:
+            # Otherwise it would sit unindexed and make every reaction in the channel fetch
+            await drop_request(req_id)
 
 @bot.tree.command(name="transfer", description="Request a currency transfer between users (admin approved).")
 @app_commands.describe(balance="banked or debt", from_user="Sender", to_user="Recipient", amount="Amount in copper", reason="Reason")
@@ -422,39 +1037,36 @@ async def transfer_command(interaction: Interaction, balance: str, from_user: di
         await interaction.followup.send("❌ You can only request transfers from your own account.", ephemeral=True)
         return
 
-    reqs = load_json(REQUESTS_FILE)
-    req_id = str(interaction.id)
-    reqs[req_id] = {
-        "type": "transfer",
-        "from": str(from_user.id),
-        "to": str(to_user.id),
-        "amount": int(amount),
-        "reason": reason,
-        "balance": balance
-    }
-    save_json(REQUESTS_FILE, reqs)
-
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id), {})
-    channel = interaction.guild.get_channel(cfg.get("request_channel"))
-    if not channel:
-        await interaction.followup.send("❌ Request channel not configured.", ephemeral=True)
-        return
-
-    amount_str = format_currency(amount, interaction.guild.id)
-    embed = discord.Embed(title="Currency Transfer Request", color=discord.Color.orange())
-    embed.add_field(name="From", value=from_user.mention, inline=True)
-    embed.add_field(name="To", value=to_user.mention, inline=True)
-    embed.add_field(name="Amount", value=f"{amount_str} ({balance})", inline=False)
-    embed.add_field(name="Reason", value=reason, inline=False)
-    embed.set_footer(text=f"Transfer | From: {from_user.id} | To: {to_user.id} | Amount: {amount} | Balance: {balance}")
-
+    async with locked(REQUESTS_FILE):
+        reqs = load_json(REQUESTS_FILE)
+        req_id = str(interaction.id)
+        data = reqs[req_id] = {
+            "type": "transfer",
+            "from": str(from_user.id),
+            "to": str(to_user.id),
+            "amount": int(amount),
+            "reason": reason,
+            "balance": balance
+        }
+        mark_dirty(REQUESTS_FILE)
+
+    # enforce_request_channel() already guaranteed we're in the configured channel
+    channel = interaction.channel
+
+    embed = build_request_embed(req_id, data, currency_formatter(interaction.guild.id))
+    msg = None
     try:
         msg = await channel.send(embed=embed)
-        await msg.add_reaction("✅")
-        await msg.add_reaction("❌")
+        async with locked(REQUESTS_FILE):
+            index_request_message(req_id, msg.id)
+        await asyncio.gather(msg.add_reaction("✅"), msg.add_reaction("❌"))
         await interaction.followup.send("📨 Transfer request submitted for approval.", ephemeral=False)
     except discord.Forbidden:
         await interaction.followup.send("❌ I don't have permission to post in the configured channel.", ephemeral=True)
+    finally:
+        if msg is None:
+            # Otherwise it would sit unindexed and make every reaction in the channel fetch
+            await drop_request(req_id)
 
 # ---------- COMMANDS: TRANSACTIONS / SETTINGS / HELP / REFRESH / RESCAN ----------
 @bot.tree.command(name="transactions", description="View recent transactions.")
@@ -469,12 +1081,13 @@ async def transactions_command(interaction: Interaction, user: discord.User = No
 
     await interaction.response.defer(ephemeral=True, thinking=True)
     user_id = str(user.id if user else interaction.user.id)
-    history = load_json(HISTORY_FILE).get(user_id, [])
+    history = load_history().get(user_id, [])
     if not history:
         await interaction.followup.send("📜 No transaction history found.", ephemeral=True)
         return
 
     lines = ["**📜 Last 10 transactions:**"]
+    fmt = currency_formatter(interaction.guild.id)
     # Show most recent last (chronological display)
     for entry in list(history)[-10:]:
         if isinstance(entry, str):
@@ -484,24 +1097,20 @@ async def transactions_command(interaction: Interaction, user: discord.User = No
         amt = int(entry.get("amount", 0))
         bal = entry.get("balance", "banked")
         sign = "+" if t in ("grant", "request", "transfer_in") else "-"
-        lines.append(f"{sign}{format_currency(amt, interaction.guild.id)} — {t.replace('_',' ').title()} ({bal}) — {entry.get('reason','')}")
-    await interaction.followup.send("\n".join(lines), ephemeral=True)
+        lines.append(f"{sign}{fmt(amt)} — {t.replace('_',' ').title()} ({bal}) — {entry.get('reason','')}")
+    await send_lines(interaction, lines, ephemeral=True)
 
 @bot.tree.command(name="settings", description="Show the current bot config for this server.")
 async def settings_command(interaction: Interaction):
     if not await enforce_request_channel(interaction):
         return
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id))
-    if not cfg:
-        await interaction.response.send_message("❌ No config found. Please run `/setup`.", ephemeral=True)
-        return
-    chan = interaction.guild.get_channel(cfg["request_channel"])
-    roles = [interaction.guild.get_role(rid) for rid in cfg.get("admin_roles", [])]
-    emoji = cfg.get("emojis", {"gold": "g", "silver": "s", "copper": "c"})
+    ctx = guild_ctx(interaction.guild.id)
+    chan = interaction.guild.get_channel(ctx.request_channel)
+    roles = [interaction.guild.get_role(rid) for rid in ctx.admin_roles]
     msg = (
         f"📥 Channel: {chan.mention if chan else 'Unknown'}\n"
         f"🔑 Admin Roles: {', '.join(r.name for r in roles if r)}\n"
-        f"💰 Emojis: {emoji['gold']} {emoji['silver']} {emoji['copper']}"
+        f"💰 Emojis: {ctx.emojis.gold} {ctx.emojis.silver} {ctx.emojis.copper}"
     )
     await interaction.response.send_message(msg, ephemeral=False)
 
@@ -534,6 +1143,7 @@ async def refresh_command(interaction: Interaction):
     await interaction.response.defer(ephemeral=True, thinking=True)
     try:
         synced = await bot.tree.sync()
+        write_command_hash(command_tree_hash())
         await interaction.followup.send(f"🔁 Synced {len(synced)} commands.", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"⚠️ Sync failed: {e}", ephemeral=True)
@@ -547,7 +1157,7 @@ async def rescan_requests(interaction: Interaction):
         return
 
     await interaction.response.defer(ephemeral=True, thinking=True)
-    cfg = load_json(CONFIG_FILE).get(str(interaction.guild.id))
+    cfg = get_guild_cfg(interaction.guild.id)
     if not cfg:
         await interaction.followup.send("❌ Bot not configured. Run `/setup`.", ephemeral=True)
         return
@@ -562,45 +1172,73 @@ async def rescan_requests(interaction: Interaction):
         await interaction.followup.send("❌ Could not fetch configured channel.", ephemeral=True)
         return
 
-    reposted = 0
-    for key, data in list(reqs.items()):
-        try:
-            t = data.get("type")
-            if t == "request":
-                user = await interaction.client.fetch_user(int(data["user_id"]))
-                amount_str = format_currency(int(data["amount"]), interaction.guild.id)
-                balance = data.get("balance", "banked")
-                embed = discord.Embed(
-                    title="Currency Request",
-                    description=f"{user.mention} is requesting {amount_str} ({balance})\nReason: {data.get('reason','')}",
-                    color=discord.Color.gold()
-                )
-                embed.set_footer(text=f"Request | User: {data['user_id']} | Amount: {data['amount']} | Balance: {balance}")
-            elif t == "transfer":
-                from_user = await interaction.client.fetch_user(int(data["from"]))
-                to_user   = await interaction.client.fetch_user(int(data["to"]))
-                amount_str = format_currency(int(data["amount"]), interaction.guild.id)
-                balance = data.get("balance", "banked")
-                embed = discord.Embed(title="Currency Transfer Request", color=discord.Color.orange())
-                embed.add_field(name="From", value=from_user.mention, inline=True)
-                embed.add_field(name="To", value=to_user.mention, inline=True)
-                embed.add_field(name="Amount", value=f"{amount_str} ({balance})", inline=False)
-                embed.add_field(name="Reason", value=data.get("reason",""), inline=False)
-                embed.set_footer(text=f"Transfer | From: {data['from']} | To: {data['to']} | Amount: {data['amount']} | Balance: {balance}")
-            else:
-                continue
+    fmt = currency_formatter(interaction.guild.id)
+    slots = asyncio.Semaphore(RESCAN_CONCURRENCY)
 
-            msg = await channel.send(embed=embed)
-            await msg.add_reaction("✅")
-            await msg.add_reaction("❌")
-            reposted += 1
+    async def repost(key, data):
+        """Returns "kept" if the request's post still exists, "reposted", or None on failure."""
+        try:
+            embed = build_request_embed(key, data, fmt)
+            if embed is None:
+                return None
+
+            async with slots:
+                msg_id = data.get("message_id")
+                if msg_id:
+                    try:
+                        await channel.fetch_message(msg_id)
+                        return "kept"
+                    except discord.NotFound:
+                        pass  # Deleted (or posted in an old channel): post it again
+                msg = await channel.send(embed=embed)
+                async with locked(REQUESTS_FILE):
+                    index_request_message(key, msg.id)
+                await asyncio.gather(msg.add_reaction("✅"), msg.add_reaction("❌"))
+            return "reposted"
         except Exception as e:
             print(f"[rescan_requests] Failed to repost: {e}")
-            continue
+            return None
 
-    await interaction.followup.send(f"🔄 Reposted {reposted} request(s).", ephemeral=True)
+    results = await asyncio.gather(*(repost(key, data) for key, data in list(reqs.items())))
+    await interaction.followup.send(
+        f"🔄 Reposted {results.count('reposted')} request(s); "
+        f"{results.count('kept')} still posted.",
+        ephemeral=True
+    )
 
 # ---------- REACTION APPROVALS ----------
+# Footers end with "| ReqID: <id>", the key of the pending entry in requests.json
+REQID_RE = re.compile(r"ReqID: (?P<req_id>\d+)")
+# Footers posted before ReqID existed:
+# "Request | User: <uid> | Amount: <amt> | Balance: <banked|debt>"
+# "Transfer | From: <uid> | To: <uid> | Amount: <amt> | Balance: <banked|debt>"
+REQUEST_FOOTER_RE = re.compile(
+    r"Request \| User: (?P<uid>\d+) \| Amount: (?P<amt>-?\d+)(?: \| Balance: (?P<bal>\w+))?"
+)
+TRANSFER_FOOTER_RE = re.compile(
+    r"Transfer \| From: (?P<from>\d+) \| To: (?P<to>\d+) \| Amount: (?P<amt>-?\d+)(?: \| Balance: (?P<bal>\w+))?"
+)
+
+def find_legacy_request(reqs, footer):
+    """Match a footer posted before ReqID was added against pending requests."""
+    m = REQUEST_FOOTER_RE.match(footer)
+    if m:
+        uid, amount, balance = m["uid"], int(m["amt"]), m["bal"]
+        for key, data in reqs.items():
+            if (data.get("type") == "request" and data.get("user_id") == uid and
+                int(data.get("amount",0)) == amount and balance in (None, data.get("balance", "banked"))):
+                return key
+        return None
+    m = TRANSFER_FOOTER_RE.match(footer)
+    if m:
+        from_id, to_id, amount, balance = m["from"], m["to"], int(m["amt"]), m["bal"]
+        for key, data in reqs.items():
+            if (data.get("type") == "transfer" and data.get("from") == from_id and
+                data.get("to") == to_id and int(data.get("amount",0)) == amount and
+                balance in (None, data.get("balance", "banked"))):
+                return key
+    return None
+
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     # Ignore own reactions
@@ -614,115 +1252,117 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
     if not guild:
         return
 
-    cfg = load_json(CONFIG_FILE).get(str(guild.id), {})
-    req_channel_id = cfg.get("request_channel")
+    req_channel_id = guild_ctx(guild.id).request_channel
     if not req_channel_id or payload.channel_id != req_channel_id:
         return  # Only in configured channel
 
-    channel = guild.get_channel(payload.channel_id)
-    if not channel:
-        return
-
-    try:
-        message = await channel.fetch_message(payload.message_id)
-    except Exception:
+    # Reactions on anything but a pending request message stop here, without
+    # fetching the message (unless legacy posts still need their footer read)
+    key = request_message_index().get(payload.message_id)
+    if key is None and not _UNINDEXED_REQS:
         return
 
-    if not message.embeds:
+    channel = guild.get_channel(payload.channel_id)
+    if not channel:
         return
 
-    # Admin-only approvals
-    member = guild.get_member(payload.user_id)
+    # Admin-only approvals; guild reaction events carry the member already
+    member = payload.member or guild.get_member(payload.user_id)
     if not member:
         try:
             member = await guild.fetch_member(payload.user_id)
         except Exception:
             return
-    admin_roles = set(cfg.get("admin_roles", []))
-    if not any(r.id in admin_roles for r in getattr(member, "roles", [])):
-        return
-
-    embed = message.embeds[0]
-    footer = embed.footer.text or ""
-    if not footer:
+    if not member_is_admin(member, guild.id):
         return
 
-    reqs = load_json(REQUESTS_FILE)
-    balances = load_json(BALANCES_FILE)
-    history = load_json(HISTORY_FILE)
-
-    def fmt(val: int) -> str:
-        return format_currency(val, guild.id)
-
-    approved = (str(payload.emoji) == "✅")
-
-    # Parse footer variants:
-    # "Request | User: <uid> | Amount: <amt> | Balance: <banked|debt>"
-    # "Transfer | From: <uid> | To: <uid> | Amount: <amt> | Balance: <banked|debt>"
-    try:
-        if footer.startswith("Request"):
-            uid = footer.split("User: ")[1].split(" |")[0]
-            amount = int(footer.split("Amount: ")[1].split(" |")[0])
-            balance = footer.split("Balance: ")[1].split(" |")[0] if "Balance:" in footer else "banked"
+    if key is None:
+        try:
+            message = await channel.fetch_message(payload.message_id)
+        except Exception:
+            return
+        if not message.embeds:
+            return
+        footer = message.embeds[0].footer.text or ""
+        if not footer.startswith(("Request", "Transfer")):
+            return
+        match = REQID_RE.search(footer)
+        key = match["req_id"] if match else None
+
+    async with locked(REQUESTS_FILE, BALANCES_FILE, HISTORY_FILE):
+        reqs = load_json(REQUESTS_FILE)
+        if key is None:
+            key = find_legacy_request(reqs, footer)
+        data = reqs.pop(key, None) if key else None
+        if not data:
+            return  # Already handled (or unknown request)
+        unindex_request(key, data)
+        mark_dirty(REQUESTS_FILE)
+
+        balances = load_json(BALANCES_FILE)
+        history = load_history()
+
+        fmt = currency_formatter(guild.id)
+
+        approved = (str(payload.emoji) == "✅")
+        dirty = set()  # data files actually modified by this event
+        notice = None  # announced after the locks are released
+        amount  = int(data.get("amount", 0))
+        balance = data.get("balance", "banked")
 
-            for key, data in list(reqs.items()):
-                if data.get("type") == "request" and data.get("user_id") == uid and int(data.get("amount",0)) == amount:
+        try:
+            if data.get("type") == "request":
+                uid = data["user_id"]
+                if approved:
                     bal = ensure_user_bucket(balances.get(uid, {}))
-                    if approved:
-                        bal[balance] = bal.get(balance, 0) + amount
-                        balances[uid] = bal
-                        history.setdefault(uid, []).append(
-                            {"type": "request", "amount": amount, "reason": data.get("reason",""), "by": "approval", "balance": balance}
-                        )
-                        await channel.send(
-                            f"✅ Approved {fmt(amount)} ({balance}) to <@{uid}>. "
-                            f"New {balance}: {fmt(bal[balance])}"
-                        )
-                    else:
-                        await channel.send(f"❌ Denied request by <@{uid}>.")
-                    del reqs[key]
-                    break
-
-        elif footer.startswith("Transfer"):
-            from_id = footer.split("From: ")[1].split(" |")[0]
-            to_id   = footer.split("To: ")[1].split(" |")[0]
-            amount  = int(footer.split("Amount: ")[1].split(" |")[0])
-            balance = footer.split("Balance: ")[1].split(" |")[0] if "Balance:" in footer else "banked"
-
-            for key, data in list(reqs.items()):
-                if (data.get("type") == "transfer" and data.get("from") == from_id and
-                    data.get("to") == to_id and int(data.get("amount",0)) == amount):
+                    bal[balance] = bal.get(balance, 0) + amount
+                    balances[uid] = bal
+                    push_history(history, uid,
+                        {"type": "request", "amount": amount, "reason": data.get("reason",""), "by": "approval", "balance": balance}
+                    )
+                    dirty.add(BALANCES_FILE)
+                    notice = (
+                        f"✅ Approved {fmt(amount)} ({balance}) to <@{uid}>. "
+                        f"New {balance}: {fmt(bal[balance])}"
+                    )
+                else:
+                    notice = f"❌ Denied request by <@{uid}>."
+
+            elif data.get("type") == "transfer":
+                from_id = data["from"]
+                to_id   = data["to"]
+                if approved:
                     from_bal = ensure_user_bucket(balances.get(from_id, {}))
                     to_bal   = ensure_user_bucket(balances.get(to_id, {}))
-                    if approved:
-                        if from_bal.get(balance, 0) >= amount:
-                            from_bal[balance] -= amount
-                            to_bal[balance]    = to_bal.get(balance, 0) + amount
-                            balances[from_id]  = from_bal
-                            balances[to_id]    = to_bal
-                            history.setdefault(from_id, []).append(
-                                {"type": "transfer_out", "amount": amount, "reason": data.get("reason",""), "by": to_id, "balance": balance}
-                            )
-                            history.setdefault(to_id, []).append(
-                                {"type": "transfer_in", "amount": amount, "reason": data.get("reason",""), "by": from_id, "balance": balance}
-                            )
-                            await channel.send(
-                                f"✅ Transfer approved! <@{from_id}> ➜ <@{to_id}> {fmt(amount)} ({balance})"
-                            )
-                        else:
-                            await channel.send(
-                                f"❌ Transfer failed: <@{from_id}> doesn't have enough {balance}."
-                            )
+                    if from_bal.get(balance, 0) >= amount:
+                        from_bal[balance] -= amount
+                        to_bal[balance]    = to_bal.get(balance, 0) + amount
+                        balances[from_id]  = from_bal
+                        balances[to_id]    = to_bal
+                        push_history(history, from_id,
+                            {"type": "transfer_out", "amount": amount, "reason": data.get("reason",""), "by": to_id, "balance": balance}
+                        )
+                        push_history(history, to_id,
+                            {"type": "transfer_in", "amount": amount, "reason": data.get("reason",""), "by": from_id, "balance": balance}
+                        )
+                        dirty.add(BALANCES_FILE)
+                        notice = f"✅ Transfer approved! <@{from_id}> ➜ <@{to_id}> {fmt(amount)} ({balance})"
                     else:
-                        await channel.send(f"❌ Transfer denied for <@{from_id}>.")
-                    del reqs[key]
-                    break
-    except Exception as e:
-        print(f"[on_raw_reaction_add] error: {e}")
+                        notice = f"❌ Transfer failed: <@{from_id}> doesn't have enough {balance}."
+                else:
+                    notice = f"❌ Transfer denied for <@{from_id}>."
+        except Exception as e:
+            print(f"[on_raw_reaction_add] error: {e}")
+
+        for path in dirty:
+            mark_dirty(path)
 
-    save_json(REQUESTS_FILE, reqs)
-    save_json(BALANCES_FILE, balances)
-    save_json(HISTORY_FILE, history)
+    # Don't hold the data locks across a Discord round-trip
+    if notice:
+        try:
+            await channel.send(notice)
+        except Exception as e:
+            print(f"[on_raw_reaction_add] error: {e}")
 
 # ---------- RUN ----------
 bot.run(os.getenv("DISCORD_TOKEN"))